@@ -1,17 +1,23 @@
 #!/usr/bin/env python
 import os
-import re
-import json
+import itertools
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 from nltk import download
 from nltk.stem import WordNetLemmatizer
 from nltk.corpus import stopwords
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from sparse_dot_topn import sp_matmul_topn
 from tqdm import tqdm
 import numpy as np
+import orjson
 import pandas as pd
 
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
 _ = download("stopwords")
 _ = download("wordnet")
 
@@ -19,32 +25,58 @@ NUM_PROCESSES = multiprocessing.cpu_count()
 MIN_SCORE = 0.4
 MIN_DF = 2
 MAX_DF = 0.8
+PARALLEL_MIN_DOCS = 100  # só evita subir o Pool para entradas triviais
+NUM_READ_THREADS = min(32, NUM_PROCESSES * 4)
+FAISS_MAX_BYTES = 8 * 1024**3
 
 _LEMMATIZER = WordNetLemmatizer()
-_STOPWORDS = set(stopwords.words("english"))
-_NON_WORD_RE = re.compile(r"[^\w\s]")
+_STOPWORDS = frozenset(stopwords.words("english"))
+
+
+def _is_word_or_space(ch):
+    return ch.isalnum() or ch.isspace() or ch == "_"
+
+
+# tabela do str.translate: minúsculas e remove o que não for \w nem \s, aplicando o
+# filtro também ao lower() (ex.: "İ" vira "i" sem o ponto combinante); preenchida
+# sob demanda por code point. Por ser caractere a caractere, não reproduz o lower()
+# dependente de contexto: o sigma final fica "σ" ("ΣΟΦΟΣ" -> "σοφοσ", não "σοφος")
+class _TranslateTable(dict):
+    def __missing__(self, code):
+        ch = chr(code)
+        value = None
+        if _is_word_or_space(ch):
+            value = "".join(c for c in ch.lower() if _is_word_or_space(c)) or None
+        self[code] = value
+        return value
 
 
-def read_content(df):
-    return df.apply(lambda x: open(x, "r", encoding="utf-8").read().lower())
+_TRANSLATE_TABLE = _TranslateTable()
 
 
-def parallel_read_content(df, num_processes=8):
-    df_split = np.array_split(df, num_processes)
-    pool = multiprocessing.Pool(num_processes)
-    data = pool.map(read_content, df_split)
-    pool.close()
-    pool.join()
+def read_content(path):
+    # modo binário: read() vai até o EOF sem TextIOWrapper, decodifica uma vez só
+    with open(path, "rb") as f:
+        return f.read().decode("utf-8", "ignore")
 
-    return pd.concat(data)
+
+def parallel_read_content(paths, num_threads=NUM_READ_THREADS):
+    # leitura é I/O e libera o GIL: threads evitam o pickle do conteúdo entre processos
+    with ThreadPoolExecutor(max_workers=num_threads) as ex:
+        return pd.Series(list(ex.map(read_content, paths.tolist())), index=paths.index)
 
 
 def load_and_read_data(path, base_folder="crawler/"):
     print(f"Carregando CSV de {path}...")
-    df = pd.read_csv(path, delimiter=",")
-    df["content_path"] = df["content_path"].apply(
-        lambda p: os.path.join(base_folder, p)
+    df = pd.read_csv(
+        path,
+        delimiter=",",
+        usecols=["url", "title", "content_path"],
+        dtype="string",
+        keep_default_na=False,  # títulos vazios continuam "" em vez de <NA>
     )
+    # como os.path.join: só acrescenta a barra se base_folder não for vazio
+    df["content_path"] = os.path.join(base_folder, "") + df["content_path"]
 
     unique_df = df.drop_duplicates(subset=["url"]).reset_index(drop=True)
     unique_df["content_text"] = parallel_read_content(unique_df["content_path"])
@@ -53,23 +85,36 @@ def load_and_read_data(path, base_folder="crawler/"):
     return unique_df
 
 
-def preprocess_text(txt):
-    txt = txt.lower()
-    txt = _NON_WORD_RE.sub("", txt)
-    tokens = txt.split()
-    tokens = [
-        _LEMMATIZER.lemmatize(t) for t in tokens if len(t) > 2 and t not in _STOPWORDS
-    ]
+def _tokenize(texts):
+    return texts.str.translate(_TRANSLATE_TABLE).str.split()
 
-    return " ".join(tokens)
+
+def preprocess_text(texts):
+    tokens = _tokenize(texts)
+
+    # WordNet só é consultado uma vez por palavra do vocabulário
+    vocab = set(itertools.chain.from_iterable(tokens)) - _STOPWORDS
+    lemmas = {t: _LEMMATIZER.lemmatize(t) for t in vocab}
+
+    return tokens.map(
+        lambda toks: " ".join([lemmas[t] for t in toks if t not in _STOPWORDS])
+    )
 
 
 def parallel_preprocess_text(texts):
+    if NUM_PROCESSES == 1 or len(texts) < PARALLEL_MIN_DOCS:
+        print("Pré-processando textos...")
+        return preprocess_text(texts)
+
+    # um pickle por bloco de documentos, não por documento
     print("Pré-processando textos em paralelo com multiprocessing.Pool...")
+    texts_split = [
+        texts.iloc[idx] for idx in np.array_split(np.arange(len(texts)), NUM_PROCESSES)
+    ]
     with multiprocessing.Pool(processes=NUM_PROCESSES) as pool:
-        processed = pool.map(preprocess_text, texts.tolist())
+        processed = pool.map(preprocess_text, texts_split)
 
-    return pd.Series(processed, index=texts.index)
+    return pd.concat(processed)
 
 
 def build_tfidf_matrix(texts):
@@ -78,9 +123,13 @@ def build_tfidf_matrix(texts):
     print("Construindo matriz TF-IDF...")
     vec = TfidfVectorizer(
         preprocessor=None,
-        tokenizer=lambda s: s.split(),
+        tokenizer=None,
+        lowercase=False,  # o texto já sai minúsculo do pré-processamento
+        token_pattern=r"(?u)\b\w{3,}\b",  # descarta termos com menos de 3 letras
         min_df=MIN_DF,
         max_df=MAX_DF,
+        dtype=np.float32,
+        norm="l2",  # linhas unitárias: produto escalar == cosseno
     )
     mat = vec.fit_transform(preprocessed)
     print(f"TF-IDF pronta: {mat.shape[0]} documentos x {mat.shape[1]} termos.")
@@ -88,61 +137,106 @@ def build_tfidf_matrix(texts):
     return mat
 
 
-def get_top_k_blocks(matrix, k=5, block_size=500):
+def _sparse_top_k(matrix, k, block_size):
+    n_docs = matrix.shape[0]
+    matrix_t = matrix.T.tocsr()  # uma vez só, fora do laço
+
+    for start in range(0, n_docs, block_size):
+        end = min(start + block_size, n_docs)
+
+        # k + 1 para sobrar espaço para a própria linha; scores abaixo de
+        # MIN_SCORE nunca saem do kernel C++
+        sims = sp_matmul_topn(
+            matrix[start:end],
+            matrix_t,
+            top_n=k + 1,
+            # o kernel só mantém scores > threshold; um passo abaixo preserva >=
+            threshold=np.nextafter(np.float32(MIN_SCORE), np.float32(0)),
+            n_threads=NUM_PROCESSES,
+        )
+        rows = np.repeat(np.arange(start, end), np.diff(sims.indptr))
+        valid = sims.indices != rows  # ignora identidade
+        rows, cols, scores = rows[valid], sims.indices[valid], sims.data[valid]
+
+        order = np.lexsort((-scores, rows))
+        rows, cols, scores = rows[order], cols[order], scores[order]
+        rank = np.arange(len(rows)) - np.searchsorted(rows, rows)  # posição na linha
+        keep = rank < k
+
+        # -1 marca vaga livre na linha
+        ids = np.full((end - start, k), -1, dtype=np.int64)
+        top_scores = np.zeros((end - start, k), dtype=matrix.dtype)
+        ids[rows[keep] - start, rank[keep]] = cols[keep]
+        top_scores[rows[keep] - start, rank[keep]] = scores[keep]
+
+        yield start, ids, top_scores
+
+
+def _faiss_top_k(matrix, k, block_size):
     n_docs = matrix.shape[0]
-    recs = {}
+    # busca exata por produto interno: com linhas unitárias é o cosseno
+    index = faiss.IndexFlatIP(matrix.shape[1])
+    for start in range(0, n_docs, block_size):
+        index.add(np.ascontiguousarray(matrix[start : start + block_size].toarray()))
 
-    print("Calculando similaridades em blocos...")
-    for start in tqdm(range(0, n_docs, block_size), desc="Blocos"):
+    for start in range(0, n_docs, block_size):
         end = min(start + block_size, n_docs)
-        block = matrix[start:end]
-
-        sims_block = cosine_similarity(block, matrix)
-        for offset, sims in enumerate(sims_block):
-            i = start + offset
-            sims[i] = -1  # ignora identidade
-
-            candidates = [
-                j for j, score in enumerate(sims) if score >= MIN_SCORE and j != i
-            ]
-            # seleciona top-k dentre candidatos
-            if len(candidates) > k:
-                scores = sims[candidates]
-                top_idx = np.argpartition(-scores, k)[:k]
-                sorted_idxs = np.array(candidates)[top_idx][
-                    np.argsort(-scores[top_idx])
-                ]
-            else:
-                sorted_idxs = sorted(candidates, key=lambda j: sims[j], reverse=True)[
-                    :k
-                ]
-            recs[i] = [(int(j), float(sims[j])) for j in sorted_idxs]
-
-    print("Similaridades calculadas.")
-    return recs
+        block = np.ascontiguousarray(matrix[start:end].toarray())
+
+        # k + 1 para sobrar espaço para a própria linha
+        scores, ids = index.search(block, k + 1)
+        valid = (ids >= 0) & (scores >= MIN_SCORE)
+        valid &= ids != np.arange(start, end)[:, None]  # ignora identidade
+
+        # compacta os válidos no começo de cada linha, mantendo a ordem do score
+        order = np.argsort(~valid, axis=1, kind="stable")[:, :k]
+        ids = np.take_along_axis(ids, order, axis=1)
+        scores = np.take_along_axis(scores, order, axis=1)
+        ids[~np.take_along_axis(valid, order, axis=1)] = -1
+
+        yield start, ids, scores
+
+
+def get_top_k_blocks(matrix, data, out_path, k=5, block_size=500, use_faiss=False):
+    n_docs, n_terms = matrix.shape
+    titles = data["title"].tolist()
+
+    if use_faiss:
+        if faiss is None:
+            raise ImportError("use_faiss=True requer o pacote faiss instalado")
+        # a matriz densa em float32 precisa caber em FAISS_MAX_BYTES
+        if n_docs * n_terms * 4 > FAISS_MAX_BYTES:
+            raise ValueError(
+                f"matriz densa de {n_docs} x {n_terms} excede FAISS_MAX_BYTES"
+            )
+        print("Calculando similaridades com FAISS...")
+        blocks = _faiss_top_k(matrix, k, block_size)
+    else:
+        print("Calculando similaridades em blocos...")
+        blocks = _sparse_top_k(matrix, k, block_size)
+
+    n_blocks = -(-n_docs // block_size)
+    with open(out_path, "wb") as f:
+        for start, ids, scores in tqdm(blocks, total=n_blocks, desc="Blocos"):
+            for i, row_ids, row_scores in zip(
+                itertools.count(start), ids.tolist(), scores.tolist()
+            ):
+                record = {
+                    "post_id": i,
+                    "title": titles[i],
+                    "recommendations": [
+                        {"id": j, "title": titles[j], "score": score}
+                        for j, score in zip(row_ids, row_scores)
+                        if j >= 0
+                    ],
+                }
+                f.write(orjson.dumps(record))
+                f.write(b"\n")
+
+    print(f"Recomendações salvas em {out_path}")
 
 
 if __name__ == "__main__":
     data = load_and_read_data("output.csv")
     tfid_mat = build_tfidf_matrix(data["content_text"])
-    recommendations = get_top_k_blocks(tfid_mat)
-
-    # for post_id, recs in recommendations.items():
-    #     print(f"\nPara o post {post_id} ({data.loc[post_id,'title']}):")
-    #     for idx, score in recs:
-    #         print(f"  → {idx}: {data.loc[idx,'title']} (score {score:.3f})")
-
-    output_file = "recommendations.jsonl"
-    with open(output_file, "w", encoding="utf-8") as f:
-        for doc_id, recs in recommendations.items():
-            record = {
-                "post_id": int(doc_id),
-                "title": data.loc[doc_id, "title"],
-                "recommendations": [
-                    {"id": int(r_id), "title": data.loc[r_id, "title"], "score": score}
-                    for r_id, score in recs
-                ],
-            }
-            f.write(json.dumps(record, ensure_ascii=False) + "\n")
-
-    print(f"Recomendações salvas em {output_file}")
+    get_top_k_blocks(tfid_mat, data, "recommendations.jsonl")